@@ -3,11 +3,15 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import asyncio
+import re
 import aiosqlite
+from collections import Counter
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
 from datetime import datetime
-from decimal import Decimal, ROUND_FLOOR, ROUND_HALF_UP
+from decimal import Decimal, ROUND_HALF_UP
+from functools import lru_cache
 from zoneinfo import ZoneInfo
-from statistics import median
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.types import Message, CallbackQuery
@@ -21,87 +25,310 @@ if not BOT_TOKEN:
 ADMIN_IDS = {int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
 TZ = os.getenv("TZ", "Europe/Moscow")
 DB_PATH = "predictions.sqlite3"
+DB_POOL_SIZE = 4  # сколько соединений с БД держим открытыми
+# Настройки каждого соединения: WAL (читатели не блокируются записью),
+# меньше fsync, временные таблицы в памяти, кэш ~20 МБ, mmap 256 МБ.
+# В режиме WAL рядом с базой появляются predictions.sqlite3-wal и -shm —
+# это часть базы: копировать/переносить только вместе с ней (или после остановки бота).
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL;",
+    "PRAGMA synchronous=NORMAL;",
+    "PRAGMA temp_store=MEMORY;",
+    "PRAGMA cache_size=-20000;",
+    "PRAGMA mmap_size=268435456;",
+    "PRAGMA busy_timeout=5000;",
+)
 
 # Баланс
 START_BALANCE = 1000  # стартовый баланс новым пользователям
 MIN_POINTS = 1
 MAX_POINTS = 10_000
 
+# Рассылка: лимит Telegram ~30 сообщений/с — шлём пачками по 25 раз в ~секунду
+SEND_BATCH = 25
+SEND_BATCH_INTERVAL = 1.05
+
 # Точность: допуск = 10% от прогноза пользователя
-TOLERANCE_RATE = Decimal("0.10")
+TOLERANCE_PCT = 10
+
+# Расчёты ведём в целых числах: 1 единица = 1/SCALE (точность 0.0001).
+# Для TIME значение в минутах тоже переводится в единицы (минуты * SCALE).
+SCALE = 10_000
+# Предел SQLite INTEGER: прогнозы больше по модулю храним только строкой
+DB_INT_MAX = 2**63 - 1
+
+# Decimal-константы создаём один раз, а не в каждом вызове
+_Q4 = Decimal("0.0001")
+# K_unique по доле k/N: (верхняя граница доли в %, коэффициент)
+_KUNIQ_STEPS = (
+    (7, Decimal("2.8")),
+    (17, Decimal("2.0")),
+    (40, Decimal("1.4")),
+)
+_KUNIQ_MIN = Decimal("1.1")
 
 # ---------------- HELPERS ----------------
+_TZ = ZoneInfo(TZ)
+
 def now_tz() -> datetime:
-    return datetime.now(ZoneInfo(TZ))
+    return datetime.now(_TZ)
 
 def dec(s: str) -> Decimal:
-    return Decimal(s.replace(",", ".").strip())
+    d = Decimal(s.replace(",", ".").strip())
+    if not d.is_finite():  # NaN / Infinity числом не считаем
+        raise ValueError(s)
+    return d
 
 def round_display(x: Decimal, q: str = "0.1") -> str:
     return str(x.quantize(Decimal(q), rounding=ROUND_HALF_UP))
 
-def validate_step(value: Decimal, step: Decimal) -> bool:
+def validate_step(value: int, step: int) -> bool:
+    """Кратность шагу; оба значения в единицах SCALE."""
     if step == 0:
         return True
-    q = value / step
-    return q == q.to_integral_value()
+    return value % step == 0
+
+# HH:MM, часы 0..23 (можно одной цифрой), минуты 00..59
+_HHMM = re.compile(r"([01]?\d|2[0-3]):([0-5]\d)")
 
 def to_minutes_hhmm(s: str, step_min: int) -> int | None:
-    s = s.strip()
-    if ":" not in s:
-        return None
-    hh, mm = s.split(":", 1)
-    if not (hh.isdigit() and mm.isdigit()):
+    m = _HHMM.fullmatch(s.strip())
+    if not m:
         return None
-    h = int(hh); m = int(mm)
-    if h < 0 or h > 23 or m < 0 or m > 59:
-        return None
-    total = h * 60 + m
+    hh, mm = m.groups()
+    total = int(hh) * 60 + int(mm)
     if step_min > 0 and total % step_min != 0:
         return None
     return total
 
+# все 1440 строк "ЧЧ:ММ" заранее, индекс = минуты от полуночи
+_HHMM_TABLE = tuple(f"{h:02d}:{m:02d}" for h in range(24) for m in range(60))
+
 def minutes_to_hhmm(minutes: int) -> str:
-    minutes = minutes % (24 * 60)
-    h = minutes // 60
-    m = minutes % 60
-    return f"{h:02d}:{m:02d}"
-
-def k_unique_from_ratio(r: Decimal) -> Decimal:
-    if r <= Decimal("0.07"):
-        return Decimal("2.8")
-    if r <= Decimal("0.17"):
-        return Decimal("2.0")
-    if r <= Decimal("0.40"):
-        return Decimal("1.4")
-    return Decimal("1.1")
-
-def k_accuracy(err: Decimal, T: Decimal) -> Decimal:
+    return _HHMM_TABLE[minutes % (24 * 60)]
+
+@lru_cache(maxsize=None)
+def k_unique(k: int, N: int) -> Decimal:
+    """K_unique по доле k/N; доля сравнивается в целых числах, без деления."""
+    for limit_pct, kuniq in _KUNIQ_STEPS:
+        if 100 * k <= limit_pct * N:
+            return kuniq
+    return _KUNIQ_MIN
+
+def to_units(value: str, qtype: str) -> int:
+    """Строка из БД (Decimal для NUM, минуты для TIME) -> целые единицы SCALE."""
+    if qtype == "TIME":
+        return int(value) * SCALE
+    return int((Decimal(value) * SCALE).to_integral_value(rounding=ROUND_HALF_UP))
+
+def dec_to_units(value: Decimal) -> int | None:
+    """Введённое число -> единицы SCALE; None, если знаков после запятой больше 4."""
+    units = value * SCALE
+    if units != units.to_integral_value():
+        return None
+    return int(units)
+
+def bet_units(forecast_value: str, forecast_units: int | None, qtype: str) -> int:
+    """Прогноз ставки в единицах SCALE; NULL в БД — значение не влезло в INTEGER, берём из строки."""
+    if forecast_units is None:
+        return to_units(forecast_value, qtype)
+    return forecast_units
+
+def from_units(units: int) -> Decimal:
+    return Decimal(units) / SCALE
+
+def tolerance(value: int, step: int) -> int:
+    """
+    Допуск max(TOLERANCE_PCT от |value|, step) без округления:
+    результат в сотых долях единицы SCALE (ошибку сравнивать как err * 100).
+    """
+    return max(abs(value) * TOLERANCE_PCT, step * 100)
+
+def k_accuracy(err: int, T: int) -> int:
+    """
+    K_accuracy = 1 + (1 - err/T) в единицах SCALE (округление до 0.0001).
+    err и T — в одних и тех же единицах.
+    """
     if err > T:
-        return Decimal("0")
-    return (Decimal("1") + (Decimal("1") - (err / T))).quantize(Decimal("0.0001"), rounding=ROUND_HALF_UP)
+        return 0
+    return (2 * (2 * SCALE * T - SCALE * err) + T) // (2 * T)
 
-def compute_bin(value: Decimal, W: Decimal) -> int:
-    return int((value / W).to_integral_value(rounding=ROUND_FLOOR))
+def compute_bin(value: int, W: int) -> int:
+    return value // W
 
-def choose_cluster_width_W(step: Decimal, all_forecasts: list[Decimal]) -> Decimal:
+def choose_cluster_width_W(step: int, all_forecasts: list[int]) -> int:
     """
     Уникальность: единая ширина кластера по вопросу.
-    W = max(step, 10% от медианы |прогнозов|)
+    W = max(step, 10% от медианы |прогнозов|), всё в единицах SCALE.
     """
     if not all_forecasts:
-        return step if step > 0 else Decimal("1")
+        return step if step > 0 else SCALE
 
-    abs_vals = [abs(x) for x in all_forecasts]
-    m = Decimal(str(median([float(x) for x in abs_vals])))
-    W = (m * TOLERANCE_RATE)
+    abs_vals = sorted(map(abs, all_forecasts))
+    n = len(abs_vals)
+    # удвоенная медиана — чтобы при чётном n остаться в целых числах
+    m2 = 2 * abs_vals[n // 2] if n % 2 else abs_vals[n // 2 - 1] + abs_vals[n // 2]
+    W = (m2 * TOLERANCE_PCT + 100) // 200
     if W <= 0:
-        W = step if step > 0 else Decimal("1")
+        W = step if step > 0 else SCALE
     if step > 0 and W < step:
         W = step
-    return W.quantize(Decimal("0.0001"), rounding=ROUND_HALF_UP)
+    return W
+
+# Текст итогов по вопросу (без строки баланса — её добавляет обработчик)
+SETTLE_TEMPLATE = (
+    "📌 Итоги по вопросу #{qid}\n"
+    "{title}\n\n"
+    "Ваш прогноз: {forecast}\n"
+    "Факт: {fact}\n"
+    "Ошибка: {err}\n"
+    "Ваш допуск (10%): {t}\n\n"
+    "K_accuracy: {acc}\n"
+    "K_unique: {kuniq} (k={k}/N={n})\n"
+    "Очки ставки: {points}\n"
+    "Начислено: {credit}"
+)
+
+def compute_payouts(qid: int, title: str, qtype: str, step: str, fact_str: str, bets) -> list[tuple[int, str, int]]:
+    """
+    Итоги по закрытому вопросу без обращения к БД и боту.
+    bets: [(user_id, forecast_value, points, forecast_units)].
+    Возвращает [(user_id, текст уведомления без строки баланса, начисление)].
+    """
+    # Уникальность: общая ширина W
+    forecasts = [bet_units(fv, units, qtype) for _uid, fv, _points, units in bets]
+    fact_val = to_units(fact_str, qtype)
+    step_u = to_units(step, qtype)
+
+    W = choose_cluster_width_W(step_u, forecasts)
+    bins = [v // W for v in forecasts]  # compute_bin без вызова функции на каждый прогноз
+    N = len(bins)
+    bin_counts = Counter(bins)
+    # K_unique зависит только от размера кластера: считаем по разу на размер
+    # (Decimal — для текста, целые десятые — для расчёта начисления)
+    kuniq_cache = {}
+    for k in set(bin_counts.values()):
+        kuniq = k_unique(k, N)
+        kuniq_cache[k] = (kuniq, int(kuniq * 10))
+
+    # общие для всех участников части текста
+    fact_disp = minutes_to_hhmm(int(fact_str)) if qtype == "TIME" else fact_str
+    fmt = SETTLE_TEMPLATE.format
+
+    results = []
+    for (user_id, fv, points, _units), user_forecast, bbin in zip(bets, forecasts, bins):
+        err = abs(user_forecast - fact_val)
+
+        # персональный допуск: 10% от прогноза, но не меньше step (в SCALE/100)
+        T_user = tolerance(user_forecast, step_u)
+
+        acc = k_accuracy(err * 100, T_user)
+
+        k = bin_counts[bbin]
+        kuniq, kuniq10 = kuniq_cache[k]
+
+        # payout = points * acc * kuniq, округление до копеек (0.01) вверх от половины;
+        # в баланс начисляем, округлив вниз до целых очков
+        num = points * acc * kuniq10 * 100
+        den = SCALE * 10
+        credit = ((2 * num + den) // (2 * den)) // 100
+
+        if qtype == "TIME":
+            forecast_disp = minutes_to_hhmm(int(fv))
+            t_disp = f"±{T_user // (SCALE * 100)} мин"
+            err_disp = f"{err // SCALE} мин"
+        else:
+            forecast_disp = fv
+            t_disp = f"±{round_display(from_units(T_user) / 100,'0.1')}"
+            err_disp = round_display(from_units(err), "0.1")
+        acc_disp = from_units(acc).quantize(_Q4) if acc else 0
+
+        msg = fmt(
+            qid=qid, title=title, forecast=forecast_disp, fact=fact_disp, err=err_disp,
+            t=t_disp, acc=acc_disp, kuniq=kuniq, k=k, n=N, points=points, credit=credit,
+        )
+        results.append((int(user_id), msg, credit))
+    return results
 
 # ---------------- DB ----------------
+# максимум id в одном IN (...) — ниже лимита параметров SQLite (999 в старых сборках)
+SQL_IN_CHUNK = 500
+
+class ConnectionPool:
+    """
+    Пул постоянных соединений aiosqlite вместо connect/close на каждый запрос.
+    Свободные соединения лежат стеком (LIFO): первым выдаётся последнее
+    использованное — у него самый "горячий" кэш страниц SQLite.
+    """
+
+    def __init__(self, path: str, size: int):
+        self._path = path
+        self._size = size
+        self._idle: list[aiosqlite.Connection] = []
+        self._slots = asyncio.Semaphore(size)
+
+    async def _open(self) -> aiosqlite.Connection:
+        db = await aiosqlite.connect(self._path)
+        try:
+            for pragma in DB_PRAGMAS:
+                await db.execute(pragma)
+        except Exception:
+            # иначе поток соединения останется жить и не даст процессу завершиться
+            await db.close()
+            raise
+        return db
+
+    async def open(self):
+        """Открывает все соединения заранее (при старте, пока пул никто не использует)."""
+        while len(self._idle) < self._size:
+            self._idle.append(await self._open())
+
+    @asynccontextmanager
+    async def connection(self):
+        async with self._slots:
+            db = self._idle.pop() if self._idle else await self._open()
+            try:
+                yield db
+            finally:
+                # незакоммиченное откатываем, как это делал close() раньше
+                if db.in_transaction:
+                    await db.rollback()
+                self._idle.append(db)
+
+    async def close(self):
+        while self._idle:
+            await self._idle.pop().close()
+
+POOL = ConnectionPool(DB_PATH, DB_POOL_SIZE)
+
+# sqlite3 кэширует подготовленные запросы в каждом соединении по тексту SQL
+# (по умолчанию 128 штук — все запросы бота помещаются):
+# запросы из нескольких мест держим в константах, чтобы текст совпадал байт в байт
+SQL_UPSERT_USER = """
+INSERT INTO users(user_id, full_name, balance, created_at)
+VALUES(?,?,?,?)
+ON CONFLICT(user_id) DO UPDATE SET full_name=excluded.full_name
+"""
+SQL_UPSERT_BET = """
+INSERT INTO bets(user_id, question_id, forecast_value, forecast_units, points, created_at)
+VALUES(?,?,?,?,?,?)
+ON CONFLICT(user_id, question_id) DO UPDATE SET
+  forecast_value=excluded.forecast_value,
+  forecast_units=excluded.forecast_units,
+  points=excluded.points,
+  created_at=excluded.created_at
+"""
+SQL_QUESTION_BETS = "SELECT user_id, forecast_value, points, forecast_units FROM bets WHERE question_id=?"
+
+# Превью после ставки: прогнозы по открытым вопросам держим в памяти,
+# чтобы не перечитывать все ставки вопроса на каждую новую. {qid: {user_id: units}}
+QAGG: dict[int, dict[int, int]] = {}
+# вопросы, закрытые за время работы бота: их в кэши больше не кладём,
+# даже если читатель успел увидеть их ещё OPEN
+_SETTLED_QIDS: set[int] = set()
+# строки открытых вопросов из get_question: {qid: row}
+_Q_CACHE: dict[int, tuple] = {}
+
 async def _ensure_column(db: aiosqlite.Connection, table: str, col: str, ddl: str):
     cur = await db.execute(f"PRAGMA table_info({table});")
     cols = [r[1] for r in await cur.fetchall()]
@@ -109,7 +336,9 @@ async def _ensure_column(db: aiosqlite.Connection, table: str, col: str, ddl: st
         await db.execute(ddl)
 
 async def db_init():
-    async with aiosqlite.connect(DB_PATH) as db:
+    # соединения живут всё время работы бота; ошибки открытия БД — сразу при старте
+    await POOL.open()
+    async with POOL.connection() as db:
         await db.execute("""
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -135,6 +364,7 @@ async def db_init():
             user_id INTEGER NOT NULL,
             question_id INTEGER NOT NULL,
             forecast_value TEXT NOT NULL, -- Decimal string for NUM, integer minutes for TIME
+            forecast_units INTEGER,       -- the same value in SCALE units, for calculations
             points INTEGER NOT NULL,
             created_at TEXT NOT NULL,
             PRIMARY KEY (user_id, question_id),
@@ -146,34 +376,98 @@ async def db_init():
             db, "users", "balance",
             "ALTER TABLE users ADD COLUMN balance INTEGER NOT NULL DEFAULT 1000;"
         )
+        # миграция: числовая копия прогноза, чтобы не разбирать строки при каждом расчёте
+        await _ensure_column(
+            db, "bets", "forecast_units",
+            "ALTER TABLE bets ADD COLUMN forecast_units INTEGER;"
+        )
+        cur = await db.execute("""
+        SELECT b.user_id, b.question_id, b.forecast_value, q.qtype
+        FROM bets b
+        JOIN questions q ON q.id=b.question_id
+        WHERE b.forecast_units IS NULL
+        """)
+        backfill = []
+        for user_id, qid, fv, qtype in await cur.fetchall():
+            units = to_units(fv, qtype)
+            # не влезает в INTEGER — оставляем NULL, читатели возьмут значение из строки
+            if abs(units) <= DB_INT_MAX:
+                backfill.append((units, user_id, qid))
+        await db.executemany(
+            "UPDATE bets SET forecast_units=? WHERE user_id=? AND question_id=?", backfill
+        )
+        # ставки по вопросу (settle, превью); PK (user_id, question_id) покрывает только выборку по user_id
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_bets_qid ON bets(question_id);")
+        # частичный индекс: только открытые вопросы
+        await db.execute("CREATE INDEX IF NOT EXISTS idx_questions_status ON questions(status) WHERE status='OPEN';")
         await db.commit()
+        # статистика для планировщика: при каждом старте SQLite сам пересобирает
+        # её для таблиц, где её нет или она устарела (0x10002 — проверять все таблицы)
+        await db.execute("PRAGMA optimize=0x10002;")
+
+async def db_close():
+    try:
+        # перед закрытием обновляем статистику по таблицам, которые заметно выросли
+        async with POOL.connection() as db:
+            await db.execute("PRAGMA optimize;")
+    finally:
+        # пул закрываем в любом случае: потоки соединений не дадут процессу завершиться
+        await POOL.close()
 
 async def upsert_user(user_id: int, full_name: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with POOL.connection() as db:
         # создаём пользователя с балансом START_BALANCE, если его нет
-        await db.execute("""
-        INSERT INTO users(user_id, full_name, balance, created_at)
-        VALUES(?,?,?,?)
-        ON CONFLICT(user_id) DO UPDATE SET full_name=excluded.full_name
-        """, (user_id, full_name or "", START_BALANCE, now_tz().isoformat()))
+        await db.execute(SQL_UPSERT_USER, (user_id, full_name or "", START_BALANCE, now_tz().isoformat()))
         await db.commit()
 
 async def get_balance(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with POOL.connection() as db:
         cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
         row = await cur.fetchone()
         return int(row[0]) if row else START_BALANCE
 
-async def add_balance(user_id: int, delta: int) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("UPDATE users SET balance = balance + ? WHERE user_id=?", (delta, user_id))
+async def _fetch_in(db: aiosqlite.Connection, sql: str, ids: list[int]) -> list[tuple]:
+    """
+    SELECT с IN-списком ({qmarks} в sql), порезанным на куски по SQL_IN_CHUNK:
+    у SQLite есть лимит числа параметров.
+    """
+    rows = []
+    for i in range(0, len(ids), SQL_IN_CHUNK):
+        chunk = ids[i:i + SQL_IN_CHUNK]
+        cur = await db.execute(sql.format(qmarks=",".join(["?"] * len(chunk))), tuple(chunk))
+        rows.extend(await cur.fetchall())
+    return rows
+
+async def credit_balances(credits: list[tuple[int, int]]) -> dict[int, int]:
+    """
+    Начисления по многим пользователям одной транзакцией (один commit вместо N).
+    credits: [(user_id, delta)]. Возвращает {user_id: новый баланс}.
+    """
+    if not credits:
+        return {}
+    user_ids = list(dict.fromkeys(uid for uid, _delta in credits))
+    created_at = now_tz().isoformat()
+    async with POOL.connection() as db:
+        # на случай если пользователь появился до миграции: обычно таких нет,
+        # поэтому сначала выясняем, кого не хватает
+        rows = await _fetch_in(db, "SELECT user_id FROM users WHERE user_id IN ({qmarks})", user_ids)
+        existing = {int(row[0]) for row in rows}
+        missing = [uid for uid in user_ids if uid not in existing]
+        if missing:
+            await db.executemany("""
+            INSERT OR IGNORE INTO users(user_id, full_name, balance, created_at)
+            VALUES(?,?,?,?)
+            """, [(uid, "", START_BALANCE, created_at) for uid in missing])
+        await db.executemany(
+            "UPDATE users SET balance = balance + ? WHERE user_id=?",
+            [(delta, uid) for uid, delta in credits],
+        )
+        rows = await _fetch_in(db, "SELECT user_id, balance FROM users WHERE user_id IN ({qmarks})", user_ids)
         await db.commit()
-        cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-        return int(row[0]) if row else 0
+        return {int(uid): int(bal) for uid, bal in rows}
 
 async def create_question(title: str, qtype: str, step: str) -> int:
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with POOL.connection() as db:
         cur = await db.execute("""
         INSERT INTO questions(title, qtype, step, status, created_at)
         VALUES(?,?,?,?,?)
@@ -182,7 +476,7 @@ async def create_question(title: str, qtype: str, step: str) -> int:
         return cur.lastrowid
 
 async def list_open_questions():
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with POOL.connection() as db:
         cur = await db.execute("""
         SELECT id, title, qtype, step FROM questions
         WHERE status='OPEN'
@@ -191,33 +485,91 @@ async def list_open_questions():
         return await cur.fetchall()
 
 async def get_question(qid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    # OPEN-вопрос меняется только при закрытии: кэшируем до settle_question
+    q = _Q_CACHE.get(qid)
+    if q is not None:
+        return q
+    async with POOL.connection() as db:
         cur = await db.execute("""
         SELECT id, title, qtype, step, status, fact_value FROM questions WHERE id=?
         """, (qid,))
-        return await cur.fetchone()
+        q = await cur.fetchone()
+    # строку могли прочитать до commit в settle_question, а вернуться сюда уже после него
+    if q and q[4] == "OPEN" and qid not in _SETTLED_QIDS:
+        _Q_CACHE[qid] = q
+    return q
 
-async def get_bet(user_id: int, qid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-        SELECT forecast_value, points FROM bets WHERE user_id=? AND question_id=?
-        """, (user_id, qid))
-        return await cur.fetchone()
+async def upsert_bets_many(rows: list[tuple[int, int, str, int, int]]):
+    """
+    Пакетная запись ставок (импорт, тесты) одной транзакцией.
+    rows: [(user_id, qid, forecast_value, forecast_units, points)]. Баланс не трогает.
+    """
+    now = now_tz().isoformat()
+    async with POOL.connection() as db:
+        await db.executemany(SQL_UPSERT_BET, [(*row, now) for row in rows])
+        await db.commit()
+    # кэш прогнозов по этим вопросам перечитаем из БД при следующей ставке
+    for _user_id, qid, *_rest in rows:
+        QAGG.pop(qid, None)
 
-async def upsert_bet(user_id: int, qid: int, forecast_value: str, points: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-        INSERT INTO bets(user_id, question_id, forecast_value, points, created_at)
-        VALUES(?,?,?,?,?)
-        ON CONFLICT(user_id, question_id) DO UPDATE SET
-          forecast_value=excluded.forecast_value,
-          points=excluded.points,
-          created_at=excluded.created_at
-        """, (user_id, qid, forecast_value, points, now_tz().isoformat()))
+async def place_bet(user_id: int, full_name: str, qid: int, forecast_value: str, forecast_units: int, points: int):
+    """
+    Ставка целиком в одной транзакции: проверка вопроса, пользователь, баланс
+    с учётом перезаписи ставки, списание и сама ставка.
+    Возвращает (result, delta_need, balance), result: OK, CLOSED или NO_BALANCE.
+    """
+    now = now_tz().isoformat()
+    async with POOL.connection() as db:
+        # IMMEDIATE: блокировку на запись берём сразу, баланс не изменится между проверкой и списанием
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute("SELECT status FROM questions WHERE id=?", (qid,))
+        row = await cur.fetchone()
+        if not row or row[0] != "OPEN":
+            return "CLOSED", 0, 0
+
+        await db.execute(SQL_UPSERT_USER, (user_id, full_name or "", START_BALANCE, now))
+        cur = await db.execute("SELECT points FROM bets WHERE user_id=? AND question_id=?", (user_id, qid))
+        old = await cur.fetchone()
+        cur = await db.execute("SELECT balance FROM users WHERE user_id=?", (user_id,))
+        bal = int((await cur.fetchone())[0])
+
+        # баланс: учитываем перезапись ставки
+        delta_need = points - (int(old[0]) if old else 0)
+        if delta_need > 0 and bal < delta_need:
+            await db.commit()
+            return "NO_BALANCE", delta_need, bal
+
+        # списываем/возвращаем разницу
+        if delta_need != 0:
+            await db.execute("UPDATE users SET balance = balance - ? WHERE user_id=?", (delta_need, user_id))
+            bal -= delta_need
+
+        await db.execute(SQL_UPSERT_BET, (user_id, qid, forecast_value, forecast_units, points, now))
         await db.commit()
+        return "OK", delta_need, bal
+
+async def get_question_forecasts(qid: int, qtype: str) -> dict[int, int]:
+    """
+    Прогнозы по открытому вопросу {user_id: значение в единицах SCALE}.
+    Читаем из БД один раз, дальше обработчик ставки обновляет QAGG сам.
+    """
+    agg = QAGG.get(qid)
+    if agg is None:
+        agg = {}
+        async with POOL.connection() as db:
+            # строки забираем по мере чтения, без промежуточного fetchall()
+            async with db.execute(SQL_QUESTION_BETS, (qid,)) as cur:
+                async for uid, fv, _points, units in cur:
+                    agg[int(uid)] = bet_units(fv, units, qtype)
+        # пока читали, вопрос могли закрыть — тогда не кэшируем;
+        # параллельный обработчик мог уже положить свой словарь — берём его,
+        # иначе его ставка пропадёт из кэша
+        if qid not in _SETTLED_QIDS:
+            agg = QAGG.setdefault(qid, agg)
+    return agg
 
 async def list_user_bets(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with POOL.connection() as db:
         cur = await db.execute("""
         SELECT b.question_id, q.title, q.qtype, q.step, q.status, b.forecast_value, b.points, q.fact_value
         FROM bets b
@@ -228,31 +580,42 @@ async def list_user_bets(user_id: int):
         return await cur.fetchall()
 
 async def settle_question(qid: int, fact_value: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
+    """
+    Закрывает OPEN-вопрос и в той же транзакции читает его ставки.
+    Возвращает [(user_id, forecast_value, points, forecast_units)] или None, если вопрос
+    не найден или уже закрыт.
+    """
+    async with POOL.connection() as db:
+        await db.execute("BEGIN IMMEDIATE")
+        cur = await db.execute("""
         UPDATE questions
         SET status='SETTLED', fact_value=?, settled_at=?
         WHERE id=? AND status='OPEN'
         """, (fact_value, now_tz().isoformat(), qid))
+        if cur.rowcount != 1:
+            return None
+        cur = await db.execute(SQL_QUESTION_BETS, (qid,))
+        bets = await cur.fetchall()
         await db.commit()
+    # после commit: запоминаем закрытый вопрос (get_question и get_question_forecasts
+    # не закэшируют его снова) и сбрасываем то, что уже лежит в кэшах
+    _SETTLED_QIDS.add(qid)
+    _Q_CACHE.pop(qid, None)
+    QAGG.pop(qid, None)
+    return bets
 
 async def get_question_bets(qid: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute("""
-        SELECT user_id, forecast_value, points
-        FROM bets
-        WHERE question_id=?
-        """, (qid,))
+    async with POOL.connection() as db:
+        cur = await db.execute(SQL_QUESTION_BETS, (qid,))
         return await cur.fetchall()
 
 async def get_users_map(user_ids: list[int]) -> dict[int, str]:
     if not user_ids:
         return {}
-    qmarks = ",".join(["?"] * len(user_ids))
-    async with aiosqlite.connect(DB_PATH) as db:
-        cur = await db.execute(f"SELECT user_id, full_name FROM users WHERE user_id IN ({qmarks})", tuple(user_ids))
-        rows = await cur.fetchall()
-        return {int(uid): (name or str(uid)) for uid, name in rows}
+    user_ids = list(dict.fromkeys(user_ids))  # без дублей, порядок сохраняем
+    async with POOL.connection() as db:
+        rows = await _fetch_in(db, "SELECT user_id, full_name FROM users WHERE user_id IN ({qmarks})", user_ids)
+    return {int(uid): name or str(uid) for uid, name in rows}
 
 # ---------------- UI ----------------
 def kb_main(is_admin: bool):
@@ -267,7 +630,15 @@ def kb_main(is_admin: bool):
     kb.adjust(1)
     return kb.as_markup()
 
+# главное меню одинаково для всех пользователей одной роли — собираем один раз
+KB_MAIN = {False: kb_main(False), True: kb_main(True)}
+
 def kb_questions(rows, prefix: str):
+    # список открытых вопросов меняется редко: кэшируем разметку по содержимому
+    return _kb_questions(tuple(rows), prefix)
+
+@lru_cache(maxsize=32)
+def _kb_questions(rows: tuple, prefix: str):
     kb = InlineKeyboardBuilder()
     for qid, title, qtype, step in rows:
         kb.button(text=f"#{qid} — {title}", callback_data=f"{prefix}:{qid}")
@@ -278,7 +649,31 @@ def kb_questions(rows, prefix: str):
 # ---------------- BOT ----------------
 bot = Bot(BOT_TOKEN)
 dp = Dispatcher()
-STATE: dict[int, dict] = {}
+
+@dataclass(slots=True)
+class UserState:
+    """Шаг диалога пользователя и то, что он уже ввёл."""
+    stage: str
+    question: tuple | None = None  # (qid, title, qtype, step) выбранного вопроса
+    forecast_value: str = ""
+    forecast_units: int = 0
+    title: str = ""  # админ: создание вопроса
+    qtype: str = ""
+
+STATE: dict[int, UserState] = {}
+
+async def broadcast(outbox: list[tuple[int, str]]):
+    """
+    Отправляет [(user_id, text)] пачками по SEND_BATCH: внутри пачки параллельно,
+    между пачками пауза, чтобы не упереться в лимит Telegram. Ошибки доставки игнорируем.
+    """
+    for i in range(0, len(outbox), SEND_BATCH):
+        if i:
+            await asyncio.sleep(SEND_BATCH_INTERVAL)
+        await asyncio.gather(
+            *(bot.send_message(user_id, text) for user_id, text in outbox[i:i + SEND_BATCH]),
+            return_exceptions=True,
+        )
 
 @dp.message(F.text.in_({"/start", "/help"}))
 async def start(m: Message):
@@ -291,12 +686,12 @@ async def start(m: Message):
         "• Допуск точности: ±10% от вашего прогноза\n"
         "• После закрытия вопроса вы получите уведомление с результатом\n"
     )
-    await m.answer(text, reply_markup=kb_main(is_admin))
+    await m.answer(text, reply_markup=KB_MAIN[is_admin])
 
 @dp.callback_query(F.data == "menu")
 async def menu(c: CallbackQuery):
     is_admin = c.from_user.id in ADMIN_IDS
-    await c.message.edit_text("Меню:", reply_markup=kb_main(is_admin))
+    await c.message.edit_text("Меню:", reply_markup=KB_MAIN[is_admin])
     await c.answer()
 
 @dp.callback_query(F.data == "user:balance")
@@ -313,20 +708,21 @@ async def bet_start(c: CallbackQuery):
     if not rows:
         await c.answer("Сейчас нет открытых вопросов.", show_alert=True)
         return
-    STATE[c.from_user.id] = {"stage": "choose_question"}
+    STATE[c.from_user.id] = UserState("choose_question")
     await c.message.edit_text("Выберите вопрос:", reply_markup=kb_questions(rows, "bet:q"))
     await c.answer()
 
 @dp.callback_query(F.data.startswith("bet:q:"))
 async def bet_choose_question(c: CallbackQuery):
-    qid = int(c.data.split(":")[-1])
+    qid = int(c.data.rpartition(":")[2])
     q = await get_question(qid)
     if not q or q[4] != "OPEN":
         await c.answer("Вопрос не найден или уже закрыт.", show_alert=True)
         return
 
     _, title, qtype, step, status, _fact = q
-    STATE[c.from_user.id] = {"stage": "enter_forecast", "qid": qid}
+    # запоминаем вопрос, чтобы не перечитывать его на каждом шаге ввода
+    STATE[c.from_user.id] = UserState("enter_forecast", question=(qid, title, qtype, step))
 
     if qtype == "NUM":
         await c.message.edit_text(
@@ -369,7 +765,7 @@ async def admin_create(c: CallbackQuery):
     if c.from_user.id not in ADMIN_IDS:
         await c.answer("Нет доступа.", show_alert=True)
         return
-    STATE[c.from_user.id] = {"stage": "admin_create_title"}
+    STATE[c.from_user.id] = UserState("admin_create_title")
     await c.message.edit_text("Создание вопроса.\n\nВведите текст вопроса (title).")
     await c.answer()
 
@@ -383,7 +779,7 @@ async def admin_showbets_pick(c: CallbackQuery):
     if not rows:
         await c.answer("Нет открытых вопросов.", show_alert=True)
         return
-    STATE[c.from_user.id] = {"stage": "admin_showbets_choose"}
+    STATE[c.from_user.id] = UserState("admin_showbets_choose")
     await c.message.edit_text("Выберите вопрос, чтобы посмотреть ставки:", reply_markup=kb_questions(rows, "admin:showbets"))
     await c.answer()
 
@@ -392,7 +788,7 @@ async def admin_showbets(c: CallbackQuery):
     if c.from_user.id not in ADMIN_IDS:
         await c.answer("Нет доступа.", show_alert=True)
         return
-    qid = int(c.data.split(":")[-1])
+    qid = int(c.data.rpartition(":")[2])
     q = await get_question(qid)
     if not q:
         await c.answer("Вопрос не найден.", show_alert=True)
@@ -409,17 +805,14 @@ async def admin_showbets(c: CallbackQuery):
     names = await get_users_map(user_ids)
 
     # выводим списком, без усложнения пагинацией (MVP)
-    lines = [f"Ставки по вопросу #{qid} ({status})", title, ""]
-    for user_id, fv, points in bets:
-        name = names.get(int(user_id), str(user_id))
-        if qtype == "TIME":
-            fv_disp = minutes_to_hhmm(int(fv))
-        else:
-            fv_disp = fv
-        lines.append(f"• {name}: {fv_disp} / {points}")
+    header = f"Ставки по вопросу #{qid} ({status})\n{title}\n\n"
+    if qtype == "TIME":
+        body = "\n".join(f"• {names.get(int(u), str(u))}: {minutes_to_hhmm(int(fv))} / {p}" for u, fv, p, _units in bets)
+    else:
+        body = "\n".join(f"• {names.get(int(u), str(u))}: {fv} / {p}" for u, fv, p, _units in bets)
 
     # Telegram лимит ~4096 символов: если очень много ставок — режем.
-    text = "\n".join(lines)
+    text = header + body
     if len(text) > 3800:
         text = text[:3800] + "\n…(обрезано, слишком много ставок)"
 
@@ -436,7 +829,7 @@ async def admin_settle_pick(c: CallbackQuery):
     if not rows:
         await c.answer("Нет открытых вопросов.", show_alert=True)
         return
-    STATE[c.from_user.id] = {"stage": "admin_settle_choose"}
+    STATE[c.from_user.id] = UserState("admin_settle_choose")
     await c.message.edit_text("Выберите вопрос для закрытия (ввода факта):", reply_markup=kb_questions(rows, "admin:settle"))
     await c.answer()
 
@@ -445,14 +838,14 @@ async def admin_settle_choose(c: CallbackQuery):
     if c.from_user.id not in ADMIN_IDS:
         await c.answer("Нет доступа.", show_alert=True)
         return
-    qid = int(c.data.split(":")[-1])
+    qid = int(c.data.rpartition(":")[2])
     q = await get_question(qid)
     if not q or q[4] != "OPEN":
         await c.answer("Вопрос уже закрыт или не найден.", show_alert=True)
         return
 
     _, title, qtype, step, status, _fact = q
-    STATE[c.from_user.id] = {"stage": "admin_settle_enter_fact", "qid": qid}
+    STATE[c.from_user.id] = UserState("admin_settle_enter_fact", question=(qid, title, qtype, step))
 
     if qtype == "NUM":
         await c.message.edit_text(f"Ввод факта.\n\nВопрос #{qid}: {title}\nВведите итоговое число (факт).")
@@ -469,40 +862,34 @@ async def on_text(m: Message):
         return
 
     # ---------- USER: forecast then points ----------
-    if st.get("stage") == "enter_forecast":
-        qid = st["qid"]
-        q = await get_question(qid)
-        if not q or q[4] != "OPEN":
-            STATE.pop(uid, None)
-            return await m.answer("Вопрос закрыт. Вернитесь в меню: /start")
-
-        _, title, qtype, step, status, _fact = q
+    if st.stage == "enter_forecast":
+        qid, title, qtype, step = st.question
 
         if qtype == "NUM":
             try:
                 v = dec(m.text)
             except Exception:
                 return await m.answer("Введите число.")
-            step_d = Decimal(step)
-            if not validate_step(v, step_d):
+            # в единицы SCALE переводим один раз, при вводе
+            v_units = dec_to_units(v)
+            # abs > DB_INT_MAX: в колонку forecast_units такое не записать
+            if v_units is None or abs(v_units) > DB_INT_MAX or not validate_step(v_units, to_units(step, qtype)):
                 return await m.answer(f"Неверный шаг. Нужно кратно {step}.")
-            st["forecast_value"] = str(v)
+            st.forecast_value = str(v)
+            st.forecast_units = v_units
         else:
             step_min = int(step)
             mins = to_minutes_hhmm(m.text, step_min)
             if mins is None:
                 return await m.answer(f"Неверный формат. Нужно HH:MM и кратно шагу {step_min} мин.")
-            st["forecast_value"] = str(mins)
+            st.forecast_value = str(mins)
+            st.forecast_units = mins * SCALE
 
-        st["stage"] = "enter_points"
+        st.stage = "enter_points"
         return await m.answer(f"Введите очки для ставки ({MIN_POINTS}–{MAX_POINTS}).")
 
-    if st.get("stage") == "enter_points":
-        qid = st["qid"]
-        q = await get_question(qid)
-        if not q or q[4] != "OPEN":
-            STATE.pop(uid, None)
-            return await m.answer("Вопрос закрыт. Ставка не сохранена. /start")
+    if st.stage == "enter_points":
+        qid, title, qtype, step = st.question
 
         try:
             pts = int(m.text.strip())
@@ -511,58 +898,38 @@ async def on_text(m: Message):
         if pts < MIN_POINTS or pts > MAX_POINTS:
             return await m.answer(f"Очки должны быть {MIN_POINTS}–{MAX_POINTS}.")
 
-        # баланс: учитываем перезапись ставки
-        await upsert_user(uid, m.from_user.full_name or "")
-        old = await get_bet(uid, qid)  # (forecast_value, points) or None
-        old_points = int(old[1]) if old else 0
-
-        bal = await get_balance(uid)
-        delta_need = pts - old_points
-        if delta_need > 0 and bal < delta_need:
+        forecast_value = st.forecast_value
+        result, delta_need, bal = await place_bet(
+            uid, m.from_user.full_name or "", qid, forecast_value, st.forecast_units, pts
+        )
+        if result == "CLOSED":
+            # вопрос закрыли, пока пользователь вводил ставку
+            STATE.pop(uid, None)
+            return await m.answer("Вопрос закрыт. Ставка не сохранена. /start")
+        if result == "NO_BALANCE":
             return await m.answer(f"Недостаточно баланса. Нужно {delta_need}, у вас {bal}.")
 
-        # списываем/возвращаем разницу
-        if delta_need != 0:
-            await add_balance(uid, -delta_need)
-            bal = await get_balance(uid)
-
-        _, title, qtype, step, status, _fact = q
-        forecast_value = st["forecast_value"]
-        await upsert_bet(uid, qid, forecast_value, pts)
-
         # Показываем кластер и текущий K_unique
-        bets = await get_question_bets(qid)
-
-        if qtype == "NUM":
-            all_forecasts = [Decimal(b[1]) for b in bets]
-            my_v = Decimal(forecast_value)
-            step_d = Decimal(step)
-        else:
-            all_forecasts = [Decimal(int(b[1])) for b in bets]
-            my_v = Decimal(int(forecast_value))
-            step_d = Decimal(int(step))
-
-        W = choose_cluster_width_W(step_d, all_forecasts)
+        my_v = st.forecast_units
+        forecasts = await get_question_forecasts(qid, qtype)
+        forecasts[uid] = my_v
+        all_forecasts = list(forecasts.values())
+        W = choose_cluster_width_W(to_units(step, qtype), all_forecasts)
         my_bin = compute_bin(my_v, W)
 
-        k = 0
-        for _u, fv, _p in bets:
-            v = Decimal(fv) if qtype == "NUM" else Decimal(int(fv))
-            if compute_bin(v, W) == my_bin:
-                k += 1
-        N = len(bets)
-        ratio = Decimal(k) / Decimal(N) if N else Decimal("1")
-        kuniq_now = k_unique_from_ratio(ratio)
+        k = Counter(v // W for v in all_forecasts)[my_bin]
+        N = len(all_forecasts)
+        kuniq_now = k_unique(k, N)  # N >= 1: прогноз пользователя уже в forecasts
 
-        cluster_from = (Decimal(my_bin) * W)
-        cluster_to = (Decimal(my_bin + 1) * W)
+        cluster_from = from_units(my_bin * W)
+        cluster_to = from_units((my_bin + 1) * W)
 
         if qtype == "TIME":
             cluster_text = f"[{minutes_to_hhmm(int(cluster_from))}; {minutes_to_hhmm(int(cluster_to))})"
-            my_disp = minutes_to_hhmm(int(my_v))
+            my_disp = minutes_to_hhmm(int(forecast_value))
         else:
             cluster_text = f"[{round_display(cluster_from,'0.1')}; {round_display(cluster_to,'0.1')})"
-            my_disp = str(my_v)
+            my_disp = forecast_value
 
         STATE.pop(uid, None)
         is_admin = uid in ADMIN_IDS
@@ -574,41 +941,41 @@ async def on_text(m: Message):
             f"Кластер (уникальность): {cluster_text}\n"
             f"Текущий K_unique: {kuniq_now} (может измениться пока вопрос открыт)\n"
             f"Баланс: {bal}",
-            reply_markup=kb_main(is_admin)
+            reply_markup=KB_MAIN[is_admin]
         )
 
     # ---------- ADMIN: create question ----------
-    if st.get("stage") == "admin_create_title":
+    if st.stage == "admin_create_title":
         if uid not in ADMIN_IDS:
             STATE.pop(uid, None)
             return await m.answer("Нет доступа.")
         title = m.text.strip()
         if len(title) < 3:
             return await m.answer("Слишком коротко. Введите нормальный текст вопроса.")
-        st["title"] = title
-        st["stage"] = "admin_create_type"
+        st.title = title
+        st.stage = "admin_create_type"
         return await m.answer("Тип вопроса: NUM (число) или TIME (время HH:MM)? Введите NUM или TIME.")
 
-    if st.get("stage") == "admin_create_type":
+    if st.stage == "admin_create_type":
         if uid not in ADMIN_IDS:
             STATE.pop(uid, None)
             return await m.answer("Нет доступа.")
         qtype = m.text.strip().upper()
         if qtype not in {"NUM", "TIME"}:
             return await m.answer("Введите NUM или TIME.")
-        st["qtype"] = qtype
-        st["stage"] = "admin_create_step"
+        st.qtype = qtype
+        st.stage = "admin_create_step"
         if qtype == "NUM":
             return await m.answer("Введите шаг (например 1 или 0.5 или 0.1).")
         else:
             return await m.answer("Введите шаг в минутах (например 5 или 10 или 15).")
 
-    if st.get("stage") == "admin_create_step":
+    if st.stage == "admin_create_step":
         if uid not in ADMIN_IDS:
             STATE.pop(uid, None)
             return await m.answer("Нет доступа.")
-        qtype = st["qtype"]
-        title = st["title"]
+        qtype = st.qtype
+        title = st.title
 
         if qtype == "NUM":
             try:
@@ -617,6 +984,8 @@ async def on_text(m: Message):
                 return await m.answer("Введите число для шага.")
             if step <= 0:
                 return await m.answer("Шаг должен быть > 0.")
+            if dec_to_units(step) is None:
+                return await m.answer("Шаг: не больше 4 знаков после запятой.")
             step_str = str(step)
         else:
             if not m.text.strip().isdigit():
@@ -632,28 +1001,25 @@ async def on_text(m: Message):
         return await m.answer(
             f"✅ Вопрос создан и открыт.\n\n#{qid}: {title}\nТип: {qtype}\nШаг: {step_str}\n\n"
             f"Ставки принимаются до публикации факта.",
-            reply_markup=kb_main(is_admin)
+            reply_markup=KB_MAIN[is_admin]
         )
 
     # ---------- ADMIN: settle question (enter fact) ----------
-    if st.get("stage") == "admin_settle_enter_fact":
+    if st.stage == "admin_settle_enter_fact":
         if uid not in ADMIN_IDS:
             STATE.pop(uid, None)
             return await m.answer("Нет доступа.")
 
-        qid = st["qid"]
-        q = await get_question(qid)
-        if not q or q[4] != "OPEN":
-            STATE.pop(uid, None)
-            return await m.answer("Вопрос уже закрыт или не найден.")
-
-        _, title, qtype, step, status, _fact = q
+        qid, title, qtype, step = st.question
 
         if qtype == "NUM":
             try:
                 fact = dec(m.text)
             except Exception:
                 return await m.answer("Введите число.")
+            # расчёт ведётся в единицах SCALE: более точный факт молча округлился бы
+            if dec_to_units(fact) is None:
+                return await m.answer("Факт: не больше 4 знаков после запятой.")
             fact_str = str(fact)
         else:
             mins = to_minutes_hhmm(m.text, step_min=1)  # факт принимаем любой HH:MM
@@ -661,100 +1027,42 @@ async def on_text(m: Message):
                 return await m.answer("Введите время в формате HH:MM.")
             fact_str = str(mins)
 
-        await settle_question(qid, fact_str)
-
-        bets = await get_question_bets(qid)
+        # статус проверяем атомарно: закрыть вопрос (и начислить) можно только один раз
+        bets = await settle_question(qid, fact_str)
+        if bets is None:
+            STATE.pop(uid, None)
+            return await m.answer("Вопрос уже закрыт или не найден.")
         if not bets:
             STATE.pop(uid, None)
             is_admin = uid in ADMIN_IDS
-            return await m.answer(f"Вопрос #{qid} закрыт. Ставок не было.", reply_markup=kb_main(is_admin))
+            return await m.answer(f"Вопрос #{qid} закрыт. Ставок не было.", reply_markup=KB_MAIN[is_admin])
 
-        # Уникальность: общая ширина W
-        if qtype == "NUM":
-            forecasts = [Decimal(b[1]) for b in bets]
-            fact_val = Decimal(fact_str)
-            step_d = Decimal(step)
-        else:
-            forecasts = [Decimal(int(b[1])) for b in bets]
-            fact_val = Decimal(int(fact_str))
-            step_d = Decimal(int(step))
-
-        W = choose_cluster_width_W(step_d, forecasts)
-        bins = [compute_bin(v, W) for v in forecasts]
-        N = len(bins)
-        bin_counts = {}
-        for b in bins:
-            bin_counts[b] = bin_counts.get(b, 0) + 1
-
-        # Рассылка + начисление в баланс
-        for user_id, fv, points in bets:
-            await upsert_user(int(user_id), "")  # на случай если пользователь появился до миграции
-            user_forecast = Decimal(fv) if qtype == "NUM" else Decimal(int(fv))
-            err = (user_forecast - fact_val).copy_abs()
-
-            # персональный допуск: 10% от прогноза, но не меньше step
-            T_user = (abs(user_forecast) * TOLERANCE_RATE)
-            if T_user < step_d:
-                T_user = step_d
-
-            acc = k_accuracy(err, T_user)
-
-            bbin = compute_bin(user_forecast, W)
-            k = bin_counts.get(bbin, 0)
-            ratio = (Decimal(k) / Decimal(N)) if N else Decimal("1")
-            kuniq = k_unique_from_ratio(ratio)
-
-            if acc == 0:
-                payout = Decimal("0")
-            else:
-                payout = (Decimal(points) * acc * kuniq).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
-
-            # начисляем payout в баланс (округляем вниз до целых очков)
-            credit = int(payout.to_integral_value(rounding=ROUND_FLOOR))
-            new_bal = await add_balance(int(user_id), credit)
-
-            if qtype == "TIME":
-                forecast_disp = minutes_to_hhmm(int(user_forecast))
-                fact_disp = minutes_to_hhmm(int(fact_val))
-                t_disp = f"±{int(T_user)} мин"
-                err_disp = f"{int(err)} мин"
-            else:
-                forecast_disp = str(user_forecast)
-                fact_disp = str(fact_val)
-                t_disp = f"±{round_display(T_user,'0.1')}"
-                err_disp = round_display(err, "0.1")
-
-            msg = (
-                f"📌 Итоги по вопросу #{qid}\n"
-                f"{title}\n\n"
-                f"Ваш прогноз: {forecast_disp}\n"
-                f"Факт: {fact_disp}\n"
-                f"Ошибка: {err_disp}\n"
-                f"Ваш допуск (10%): {t_disp}\n\n"
-                f"K_accuracy: {acc}\n"
-                f"K_unique: {kuniq} (k={k}/N={N})\n"
-                f"Очки ставки: {points}\n"
-                f"Начислено: {credit}\n"
-                f"Баланс: {new_bal}"
-            )
-            try:
-                await bot.send_message(int(user_id), msg)
-            except Exception:
-                pass
+        # расчёт — чистая функция, уводим его с event loop
+        results = await asyncio.to_thread(compute_payouts, qid, title, qtype, step, fact_str, bets)
+        new_bal_map = await credit_balances([(user_id, credit) for user_id, _msg, credit in results])
+        await broadcast([
+            (user_id, f"{msg}\nБаланс: {new_bal_map.get(user_id, 0)}")
+            for user_id, msg, _credit in results
+        ])
 
         STATE.pop(uid, None)
         is_admin = uid in ADMIN_IDS
         return await m.answer(
             f"✅ Вопрос #{qid} закрыт, факт сохранён, начисления и уведомления отправлены.",
-            reply_markup=kb_main(is_admin)
+            reply_markup=KB_MAIN[is_admin]
         )
 
 # ---------------- MAIN ----------------
 async def main():
-    await db_init()
-    # Важно для хостинга: сбрасываем webhook, чтобы polling работал стабильно
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    try:
+        # внутри try: db_init уже держит открытые соединения пула, при ошибке их надо закрыть
+        await db_init()
+        # Важно для хостинга: сбрасываем webhook, чтобы polling работал стабильно
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        await bot.session.close()
+        await db_close()
 
 if __name__ == "__main__":
     asyncio.run(main())